@@ -1,54 +1,196 @@
 from flask import Flask, request, render_template, send_file, redirect, url_for, flash
+import glob
 import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
-from tools import read_docx, classify_balance_sheet, extract_json, write_to_pdf
+from tools import read_docx, classify_balance_sheet, classify_balance_sheets, extract_json, write_many_to_pdf
 
 # Use /tmp for Vercel (serverless environment)
 UPLOAD_FOLDER = '/tmp'
 ALLOWED_EXTENSIONS = {'docx'}
+# .docx files are ZIP archives, which start with a local file header
+DOCX_MAGIC = b'PK\x03\x04'
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Balance sheets accepted per upload; several go to Groq in one batched call
+MAX_FILES = 5
+# Finished PDFs and error markers are deleted after this many seconds
+RESULT_TTL = int(os.getenv('RESULT_TTL', '3600'))
+# A job whose uploads are older than this and has no result died mid-run
+# (worker restart, serverless timeout); Groq retries alone can take ~8 minutes
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', '900'))
+COPY_BUFFER_SIZE = 1024 * 1024
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'supersecretkey')
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# On a long-lived server uploads are processed in a background thread so the
+# request returns at once. Vercel freezes the function after the response, so
+# there (or with BACKGROUND_JOBS=0) the job runs inside the upload request.
+# Job state lives on disk so any worker sharing UPLOAD_FOLDER can report it:
+# <job_id>.pdf means done, <job_id>.err means failed, uploads still present
+# means pending.
+BACKGROUND_JOBS = os.getenv('BACKGROUND_JOBS', '0' if os.getenv('VERCEL') else '1') == '1'
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('PIPELINE_WORKERS', '4'))) if BACKGROUND_JOBS else None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def looks_like_docx(file):
+    # Peek at the first bytes so junk is rejected before it is written to disk
+    head = file.stream.read(len(DOCX_MAGIC))
+    file.stream.seek(0)
+    return head == DOCX_MAGIC
+
+def save_upload(file, filepath):
+    # Copy the upload stream to disk in large chunks, unbuffered on our side
+    with open(filepath, 'wb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        shutil.copyfileobj(file.stream, f, length=COPY_BUFFER_SIZE)
+
+def valid_job_id(job_id):
+    # Job ids are uuid4 hex strings; anything else must not reach a file path
+    return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+def pdf_path_for(job_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'{job_id}.pdf')
+
+def error_path_for(job_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'{job_id}.err')
+
+def uploads_for(job_id):
+    return glob.glob(os.path.join(app.config['UPLOAD_FOLDER'], f'{job_id}_*'))
+
+def process_files(filepaths, pdf_path):
+    texts = [read_docx(filepath) for filepath in filepaths]
+    if len(texts) == 1:
+        results = [extract_json(classify_balance_sheet(texts[0]))]
+    else:
+        results = classify_balance_sheets(texts)
+    write_many_to_pdf(results, pdf_path)
+
+def run_job(job_id, filepaths):
+    try:
+        process_files(filepaths, pdf_path_for(job_id))
+    except Exception as e:
+        app.logger.exception('Job %s failed', job_id)
+        with open(error_path_for(job_id), 'w') as f:
+            f.write(str(e))
+    finally:
+        # Removed only after the .pdf/.err exists, so the job never looks unknown
+        for filepath in filepaths:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+
+def expire_old_results():
+    # /tmp on Vercel is small; drop results nobody downloaded within RESULT_TTL,
+    # along with uploads left behind by jobs that never finished
+    cutoff = time.time() - RESULT_TTL
+    folder = app.config['UPLOAD_FOLDER']
+    for pattern in ('*.pdf', '*.err', '*_*'):
+        for path in glob.glob(os.path.join(folder, pattern)):
+            name = os.path.basename(path)
+            if pattern == '*_*':
+                job_id = name[:32] if name[32:33] == '_' else ''
+            else:
+                job_id = os.path.splitext(name)[0]
+            try:
+                if valid_job_id(job_id) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def job_timed_out(uploads):
+    try:
+        return time.time() - max(os.path.getmtime(path) for path in uploads) > JOB_TIMEOUT
+    except (FileNotFoundError, ValueError):
+        return False
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
+        expire_old_results()
         if 'file' not in request.files:
             flash('No file part')
             return redirect(request.url)
-        file = request.files['file']
-        if file.filename == '':
+        files = [file for file in request.files.getlist('file') if file.filename != '']
+        if not files:
             flash('No selected file')
             return redirect(request.url)
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            # Process file
-            text = read_docx(filepath)
-            result_json = classify_balance_sheet(text)
-            result_json = extract_json(result_json)
-            pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'reclassified_output.pdf')
-            write_to_pdf(result_json, pdf_path)
-            # After processing, show result page with download link only
-            return render_template('result.html')
+        if len(files) > MAX_FILES:
+            flash(f'Upload at most {MAX_FILES} balance sheets at a time')
+            return redirect(request.url)
+        if all(allowed_file(file.filename) and looks_like_docx(file) for file in files):
+            # Prefix with the job id so concurrent uploads of the same name don't collide
+            job_id = uuid.uuid4().hex
+            filepaths = []
+            for n, file in enumerate(files):
+                filename = secure_filename(file.filename)
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{job_id}_{n}_{filename}')
+                save_upload(file, filepath)
+                filepaths.append(filepath)
+            # Run or queue processing and send the user to the job status page
+            if executor is not None:
+                executor.submit(run_job, job_id, filepaths)
+            else:
+                run_job(job_id, filepaths)
+            return redirect(url_for('job_status', job_id=job_id))
         else:
             flash('Allowed file type is .docx')
             return redirect(request.url)
     return render_template('upload.html')
 
-@app.route('/download')
-def download_pdf():
-    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'reclassified_output.pdf')
-    if os.path.exists(pdf_path):
-        return send_file(pdf_path, as_attachment=True)
+@app.errorhandler(413)
+def upload_too_large(error):
+    flash(f'File is too large. The maximum upload size is {MAX_UPLOAD_SIZE // (1024 * 1024)} MB.')
+    return redirect(url_for('upload_file'))
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if valid_job_id(job_id):
+        # Read uploads before the markers: run_job removes them only after a
+        # marker exists, so no uploads and no marker really means unknown
+        uploads = uploads_for(job_id)
+        if os.path.exists(pdf_path_for(job_id)):
+            # After processing, show result page with download link only
+            return render_template('result.html', job_id=job_id)
+        if os.path.exists(error_path_for(job_id)):
+            with open(error_path_for(job_id)) as f:
+                flash(f'Processing failed: {f.read()}')
+            return redirect(url_for('upload_file'))
+        if uploads:
+            if job_timed_out(uploads):
+                flash('Processing did not finish. Please upload the file again.')
+                return redirect(url_for('upload_file'))
+            return render_template('pending.html', job_id=job_id)
+    flash('Unknown job. Please upload the file again.')
+    return redirect(url_for('upload_file'))
+
+@app.route('/download/<job_id>')
+def download_pdf(job_id):
+    pdf_path = pdf_path_for(job_id)
+    if valid_job_id(job_id) and os.path.exists(pdf_path):
+        # Conditional responses let retried downloads get a 304 or a byte range
+        # instead of the whole PDF again; max_age=0 makes browsers revalidate
+        return send_file(
+            pdf_path,
+            as_attachment=True,
+            download_name='reclassified_output.pdf',
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(pdf_path),
+            max_age=0,
+        )
     else:
         flash('PDF not found. Please upload and process a file first.')
         return redirect(url_for('upload_file'))
@@ -1,305 +1,715 @@
 import os
-import re
+import io
 import json
-import docx
-import pandas as pd
+import math
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+import groq
+import httpx
+import orjson
 from groq import Groq
-from pydantic import BaseModel
+from lxml import etree
 
 # Init Groq client
 api_key = os.getenv("GROQ_API_KEY")
 if not api_key:
     raise EnvironmentError("GROQ_API_KEY environment variable not set.")
-client = Groq(api_key=api_key)
+# Reuse one pooled HTTP client so warm workers keep the TLS connection to Groq
+# alive between requests instead of doing a fresh handshake per upload
+http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60),
+    timeout=httpx.Timeout(120.0, connect=10.0),
+)
+# Retries are handled by _chat_completion so they go through the rate limiter
+client = Groq(api_key=api_key, http_client=http_client, max_retries=0)
+
+# Client-side limits, matched to the Groq plan in use
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "8000"))
+MAX_RETRIES = 3
+
+
+class _TokenBucket:
+    """Thread-safe token bucket refilled continuously at per_minute tokens per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # More than a full bucket can never be granted, and Groq rejects such
+        # a request anyway; fail now so the caller can split it instead
+        if amount > self.capacity:
+            raise ValueError(f"Request needs about {amount} tokens, above the limit of {self.capacity} per minute")
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Shared by every request thread in this worker
+_request_bucket = _TokenBucket(GROQ_RPM)
+_token_bucket = _TokenBucket(GROQ_TPM)
+
+
+def _estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2 ** attempt
+    return min(delay, 30) + random.uniform(0, 0.5)
+
+
+def _chat_completion(system, user):
+    """
+    Send a system + user prompt to Groq, waiting for the RPM/TPM budget first.
+
+    Rate limit (429) and server errors are retried up to MAX_RETRIES times
+    with exponential backoff, honouring the retry-after header when present.
+    Raises ValueError when the request alone is larger than GROQ_TPM.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        # Groq counts completion tokens against TPM too; the JSON reply is
+        # about as long as the document, as assumed in _split_batches.
+        # Taken first so an oversized request fails without using up an RPM slot
+        _token_bucket.acquire(_estimate_tokens(system) + 2 * _estimate_tokens(user))
+        _request_bucket.acquire()
+        try:
+            response = client.chat.completions.create(
+                model="openai/gpt-oss-20b",  # or smaller one if needed
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": user},
+                ],
+                temperature=0
+            )
+            return response.choices[0].message.content
+        except (groq.RateLimitError, groq.InternalServerError, groq.APIConnectionError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(_retry_delay(e, attempt))
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = _W + "p"
+_W_R = _W + "r"
+_W_T = _W + "t"
+_W_TAB = _W + "tab"
+_RUN_BREAKS = {_W_TAB: "\t", _W + "br": "\n", _W + "cr": "\n"}
+# Word stores text boxes twice, as mc:Choice (DrawingML) and mc:Fallback (VML)
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+
+def _iter_paragraphs(path):
+    """
+    Yield the text of every paragraph in a .docx, in document order.
+
+    Streams word/document.xml with iterparse and clears each paragraph once
+    read, instead of building python-docx's object tree for the whole file.
+    """
+    with zipfile.ZipFile(path) as z, z.open("word/document.xml") as f:
+        for _, el in etree.iterparse(f, tag=_W_P):
+            # Only read the Choice copy of a text box; the Fallback is still
+            # cleared below so its text doesn't leak into the outer paragraph
+            if next(el.iterancestors(_MC_FALLBACK), None) is None:
+                parts = []
+                for node in el.iter(_W_T, *_RUN_BREAKS):
+                    if node.tag == _W_T:
+                        parts.append(node.text or "")
+                    elif node.getparent().tag == _W_R:  # tab stops in w:pPr are not text
+                        parts.append(_RUN_BREAKS[node.tag])
+                yield "".join(parts)
+
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
 
 def read_docx(path):
-    doc = docx.Document(path)
-    full_text = []
-    for para in doc.paragraphs:
-        if para.text.strip():
-            full_text.append(para.text.strip())
-    return "\n".join(full_text)
+    # Strip each paragraph once and drop empty ones in a single pass
+    return "\n".join(s for s in (p.strip() for p in _iter_paragraphs(path)) if s)
 
-def classify_balance_sheet(text: str):
-    prompt = f"""
+# The instructions are identical for every call, so they go in a fixed system
+# message and only the document text changes; this also lets the backend reuse
+# its cached prefix where prompt caching is available
+_SYSTEM_PROMPT = """
     You are a financial assistant.
     Input: an unstructured analytical balance sheet.
     Task: Reclassify all items into the EU Article 2424 balance sheet schema (CEE).
     Return the result as JSON with two main keys: ATTIVO and PASSIVO.
     Each section should have subcategories (A, B, C, D, E) with items and amounts.
     Example:
-    {{
-      "ATTIVO": {{
+    {
+      "ATTIVO": {
         "B) Immobilizzazioni immateriali": [
-          {{"label": "Software", "amount": 3041.40}},
+          {"label": "Software", "amount": 3041.40},
           ...
         ],
         "B) Immobilizzazioni materiali": [
           ...
         ]
-      }},
-      "PASSIVO": {{
+      },
+      "PASSIVO": {
         "A) Patrimonio netto": [...],
         "D) Debiti": [...]
-      }}
-    }}
-    Balance sheet text:
-    {text}
+      }
+    }
+    The user message contains the balance sheet text.
+    """
+
+_BATCH_SYSTEM_PROMPT = """
+    You are a financial assistant.
+    Input: several unstructured analytical balance sheets, each starting with "Document <i>:" and ending with "---".
+    Task: Reclassify all items of each document into the EU Article 2424 balance sheet schema (CEE).
+    Return a JSON array with one object per document. Each object has the key "i" (the document number)
+    and two main keys: ATTIVO and PASSIVO.
+    Each section should have subcategories (A, B, C, D, E) with items and amounts.
+    Example:
+    [
+      {
+        "i": 0,
+        "ATTIVO": {
+          "B) Immobilizzazioni immateriali": [
+            {"label": "Software", "amount": 3041.40},
+            ...
+          ]
+        },
+        "PASSIVO": {
+          "A) Patrimonio netto": [...],
+          "D) Debiti": [...]
+        }
+      },
+      ...
+    ]
+    The user message contains the balance sheets.
     """
 
-    response = client.chat.completions.create(
-        model="openai/gpt-oss-20b",  # or smaller one if needed
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
 
-    result = response.choices[0].message.content
+def classify_balance_sheet(text: str):
+    result = _chat_completion(_SYSTEM_PROMPT, text)
     print(result)
     return result
 
-import json
+
+# Limits for one batched request: the prompt plus the expected JSON output
+# (roughly the size of the input again) has to fit inside the model context
+MAX_BATCH_SIZE = 8
+MAX_BATCH_TOKENS = 32000
+
+
+def _document_block(n, text):
+    return f"Document {n}:\n{text}\n---\n"
+
+
+def _split_batches(texts):
+    """Yield lists of indices into texts that fit in a single request."""
+    # Groq rejects any request larger than the per-minute token limit (413),
+    # so a batch also has to fit in GROQ_TPM next to the system prompt
+    budget = min(MAX_BATCH_TOKENS, GROQ_TPM) - _estimate_tokens(_BATCH_SYSTEM_PROMPT)
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        cost = 2 * _estimate_tokens(_document_block(len(batch), text))
+        if batch and (len(batch) >= MAX_BATCH_SIZE or batch_tokens + cost > budget):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += cost
+    if batch:
+        yield batch
+
+
+def classify_balance_sheets(texts):
+    """
+    Reclassify several balance sheets with as few Groq calls as possible.
+
+    Documents are packed into one prompt per batch and the model answers with
+    a JSON array, so N uploads cost ceil(N / MAX_BATCH_SIZE) requests instead of N.
+
+    Args:
+        texts: List of balance sheet texts (as returned by read_docx)
+
+    Returns:
+        List of dicts with ATTIVO and PASSIVO sections, in the order of texts.
+        Documents the batched reply leaves out (or garbles) are reclassified
+        one at a time with classify_balance_sheet.
+    """
+    results = [None] * len(texts)
+
+    for batch in _split_batches(texts):
+        documents = "".join(_document_block(n, texts[i]) for n, i in enumerate(batch))
+        try:
+            entries = extract_json_array(_chat_completion(_BATCH_SYSTEM_PROMPT, documents))
+        except ValueError:
+            entries = []
+        except groq.APIStatusError as e:
+            # Batch too large for the plan's limits; classify its documents one by one
+            if e.status_code != 413:
+                raise
+            entries = []
+        if not isinstance(entries, list):
+            entries = []
+
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            try:
+                n = int(entry.pop("i", None))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= n < len(batch):
+                results[batch[n]] = entry
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = extract_json(classify_balance_sheet(texts[i]))
+    return results
+
+
+# Fallback decoder for responses where the bracket slice is not valid JSON
+_json_decoder = json.JSONDecoder()
+
+
+def _decode_json_block(cleaned, open_char, close_char):
+    start = cleaned.find(open_char)
+    end = cleaned.rfind(close_char)
+    if start < 0 or end < start:
+        return None
+    try:
+        return orjson.loads(cleaned[start:end + 1])
+    except orjson.JSONDecodeError:
+        # Text after the JSON contained another bracket; raw_decode stops at
+        # the end of the first complete value instead
+        data, _ = _json_decoder.raw_decode(cleaned, start)
+        return data
 
 
 def extract_json(json_str):
     # Remove surrounding Python triple quotes if any
     cleaned = json_str.strip("'''").strip('"""').strip()
 
-    # Extract the JSON block
-    match = re.search(r"\{.*\}", cleaned, re.DOTALL)
-    if match:
-        return json.loads(match.group())
-    else:
+    data = _decode_json_block(cleaned, "{", "}")
+    if data is None:
         raise ValueError("No JSON found in the Groq response")
+    return data
+
+
+def extract_json_array(json_str):
+    # Same as extract_json, for batched responses that return a list
+    cleaned = json_str.strip("'''").strip('"""').strip()
+
+    data = _decode_json_block(cleaned, "[", "]")
+    if data is None:
+        raise ValueError("No JSON array found in the Groq response")
+    return data
 
 def write_excel_from_json(json_str, output_file="reclassified.xlsx"):
-    data = json.loads(json_str)
-
-    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
-        for section, items in data.items():  # ATTIVO, PASSIVO
-            # Flatten subcategories
-            rows = []
-            for subcat, records in items.items():
-                for rec in records:
-                    rows.append({
-                        "section": section,
-                        "subcategory": subcat,
-                        "label": rec.get("label"),
-                        "amount": rec.get("amount")
-                    })
-            df = pd.DataFrame(rows)
-            df.to_excel(writer, sheet_name=section, index=False)
+    # Imported here: the web app never writes Excel, so keep it off the cold-start path
+    from openpyxl import Workbook
+
+    data = orjson.loads(json_str)
+
+    # write_only streams rows to disk instead of keeping every cell in memory
+    wb = Workbook(write_only=True)
+    for section, items in data.items():  # ATTIVO, PASSIVO
+        ws = wb.create_sheet(section)
+        ws.append(["section", "subcategory", "label", "amount"])
+        # Flatten subcategories
+        for subcat, records in items.items():
+            for rec in records:
+                ws.append([section, subcat, rec.get("label"), rec.get("amount")])
+    wb.save(output_file)
 
     print(f"✅ Reclassified Excel saved to {output_file}")
 
 
+from pypdf import PdfWriter
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+
+# Page geometry: 2 cm margins, 16 cm table centred in the 17 cm frame
+_PAGE_WIDTH, _PAGE_HEIGHT = A4
+_MARGIN = 2 * cm
+_TOP = _PAGE_HEIGHT - _MARGIN
+_BOTTOM = _MARGIN
+_COL_WIDTHS = [12 * cm, 4 * cm]
+_TABLE_WIDTH = sum(_COL_WIDTHS)
+_TABLE_X = (_PAGE_WIDTH - _TABLE_WIDTH) / 2
+_CELL_PADDING = 6
+# Headings sit inside the frame padding Platypus used, 6 pt on each side
+_TEXT_X = _MARGIN + 6
+_TEXT_WIDTH = _PAGE_WIDTH - 2 * _TEXT_X
+
+# Thousands separator, two decimals (e.g. 3,041.40)
+_AMOUNT_FORMAT = ",.2f"
+
+_TextStyle = namedtuple("_TextStyle", "font size leading color space_before space_after centered")
+_RowStyle = namedtuple("_RowStyle", "font size background text_color pad_top pad_bottom grid line_above")
+
+_TITLE_STYLE = _TextStyle("Helvetica-Bold", 16, 22, colors.HexColor('#1f4788'), 0, 20 + 0.5 * cm, True)
+_SECTION_STYLE = _TextStyle("Helvetica-Bold", 14, 18, colors.HexColor('#2c5f9e'), 12, 12, False)
+_SUBSECTION_STYLE = _TextStyle("Helvetica-BoldOblique", 11, 14, colors.HexColor('#444444'), 8, 8, False)
+
+_HEADER_ROW = _RowStyle("Helvetica-Bold", 10, colors.HexColor('#2c5f9e'), colors.whitesmoke, 3, 12, True, False)
+_DATA_ROW = _RowStyle("Helvetica", 9, colors.beige, colors.black, 3, 3, True, False)
+_SUBTOTAL_ROW = _RowStyle("Helvetica-Bold", 10, colors.HexColor('#d9e8f5'), colors.black, 3, 3, False, True)
+_TOTAL_ROW = _RowStyle("Helvetica-Bold", 12, colors.HexColor('#1f4788'), colors.whitesmoke, 12, 12, False, False)
+
+_TABLE_GAP = 0.3 * cm
+
+_DOCUMENT_TITLE = "Reclassified Balance Sheet - Article 2424 CEE"
+_ATTIVO_TITLE = "ATTIVO (Assets)"
+_PASSIVO_TITLE = "PASSIVO (Liabilities & Equity)"
+_SECTIONS = (("ATTIVO", _ATTIVO_TITLE), ("PASSIVO", _PASSIVO_TITLE))
+
+
+def _row_height(style):
+    return style.size * 1.2 + style.pad_top + style.pad_bottom
+
+
+class _PdfWriter:
+    """Draws the balance sheet straight onto a ReportLab canvas, top to bottom."""
+
+    def __init__(self, output_path):
+        self.canvas = canvas.Canvas(output_path, pagesize=A4)
+        self.y = _TOP
+
+    def new_page(self):
+        self.canvas.showPage()
+        self.y = _TOP
+
+    def ensure_space(self, height):
+        if self.y - height < _BOTTOM:
+            self.new_page()
+
+    def text(self, value, style):
+        lines = simpleSplit(value, style.font, style.size, _TEXT_WIDTH) or [""]
+        # Like Platypus, drop the space before a heading at the top of a page
+        if self.y < _TOP:
+            self.y -= style.space_before
+        c = self.canvas
+        c.setFont(style.font, style.size)
+        c.setFillColor(style.color)
+        for line in lines:
+            self.y -= style.leading
+            baseline = self.y + (style.leading - style.size) / 2
+            if style.centered:
+                c.drawCentredString(_PAGE_WIDTH / 2, baseline, line)
+            else:
+                c.drawString(_TEXT_X, baseline, line)
+        self.y -= style.space_after
+
+    def row(self, label, amount, style, center=False):
+        height = _row_height(style)
+        self.ensure_space(height)
+        self.y -= height
+        x, y, c = _TABLE_X, self.y, self.canvas
+        label_width, amount_width = _COL_WIDTHS
+
+        c.setFillColor(style.background)
+        c.rect(x, y, _TABLE_WIDTH, height, stroke=0, fill=1)
+        if style.grid:
+            c.setStrokeColor(colors.grey)
+            c.setLineWidth(0.5)
+            c.rect(x, y, label_width, height, stroke=1, fill=0)
+            c.rect(x + label_width, y, amount_width, height, stroke=1, fill=0)
+        if style.line_above:
+            c.setStrokeColor(colors.black)
+            c.setLineWidth(1.5)
+            c.line(x, y + height, x + _TABLE_WIDTH, y + height)
+
+        c.setFont(style.font, style.size)
+        c.setFillColor(style.text_color)
+        baseline = y + style.pad_bottom + style.size * 0.2
+        if center:
+            c.drawCentredString(x + label_width / 2, baseline, label)
+            c.drawCentredString(x + label_width + amount_width / 2, baseline, amount)
+        else:
+            c.drawString(x + _CELL_PADDING, baseline, label)
+            c.drawRightString(x + _TABLE_WIDTH - _CELL_PADDING, baseline, amount)
+
+    def body_rows(self, labels, amounts):
+        """
+        Draw the data rows of a table, continuing on new pages as needed.
+
+        labels and amounts are parallel lists holding the two column values.
+
+        Rows that fit on the current page are drawn as one block: a single
+        background rect, one path for the grid and one text object, instead
+        of a handful of canvas operations per row.
+        """
+        style = _DATA_ROW
+        height = _row_height(style)
+        label_width = _COL_WIDTHS[0]
+        x, c = _TABLE_X, self.canvas
+        right = x + _TABLE_WIDTH - _CELL_PADDING
+
+        start, count = 0, len(labels)
+        while start < count:
+            fit = int((self.y - _BOTTOM) // height)
+            if fit <= 0:
+                self.new_page()
+                self.table_header()
+                continue
+            end = min(start + fit, count)
+            block_labels = labels[start:end]
+            block_amounts = amounts[start:end]
+            start = end
+
+            top = self.y
+            bottom = top - len(block_labels) * height
+
+            c.setFillColor(style.background)
+            c.rect(x, bottom, _TABLE_WIDTH, top - bottom, stroke=0, fill=1)
+
+            grid = [(x, bottom + k * height, x + _TABLE_WIDTH, bottom + k * height) for k in range(len(block_labels))]
+            grid += [(cx, bottom, cx, top) for cx in (x, x + label_width, x + _TABLE_WIDTH)]
+            c.setStrokeColor(colors.grey)
+            c.setLineWidth(0.5)
+            c.lines(grid)
+
+            text = c.beginText()
+            text.setFont(style.font, style.size)
+            text.setFillColor(style.text_color)
+            baseline = top - height + style.pad_bottom + style.size * 0.2
+            for label, amount in zip(block_labels, block_amounts):
+                text.setTextOrigin(x + _CELL_PADDING, baseline)
+                text.textOut(label)
+                text.setTextOrigin(right - stringWidth(amount, style.font, style.size), baseline)
+                text.textOut(amount)
+                baseline -= height
+            c.drawText(text)
+
+            self.y = bottom
+
+    def table_header(self):
+        self.row("Description", "Amount (€)", _HEADER_ROW, center=True)
+
+    def save(self):
+        self.canvas.save()
+
+
+def _render_section(writer, name, title, items_dict):
+    """
+    Draw one balance sheet section (ATTIVO or PASSIVO).
+
+    Args:
+        writer: _PdfWriter for the document being built
+        name: Section key, used for the total row (e.g. "ATTIVO")
+        title: Heading shown above the section
+        items_dict: Mapping of category name to list of items
+    """
+    writer.text(title, _SECTION_STYLE)
+
+    # Local alias skips the builtins lookup for every cell
+    fmt = format
+    # Keep a category heading on the same page as its first rows
+    heading_space = (_SUBSECTION_STYLE.space_before + _SUBSECTION_STYLE.space_after
+                     + _row_height(_HEADER_ROW) + _row_height(_DATA_ROW))
+
+    # fsum keeps cents exact where a running float sum would drift
+    category_subtotals = []
+    for category, items in items_dict.items():
+        if items:  # Only process if there are items
+            heading_lines = len(simpleSplit(category, _SUBSECTION_STYLE.font, _SUBSECTION_STYLE.size, _TEXT_WIDTH))
+            writer.ensure_space(heading_space + max(heading_lines, 1) * _SUBSECTION_STYLE.leading)
+            writer.text(category, _SUBSECTION_STYLE)
+            writer.table_header()
+
+            # One list per column instead of a small list per row
+            labels = [str(item.get("label") or "") for item in items]
+            amounts = [item.get("amount", 0) or 0 for item in items]
+            writer.body_rows(labels, [fmt(amount, _AMOUNT_FORMAT) for amount in amounts])
+
+            subtotal = math.fsum(amounts)
+            writer.row("Subtotal", fmt(subtotal, _AMOUNT_FORMAT), _SUBTOTAL_ROW)
+            category_subtotals.append(subtotal)
+            writer.y -= _TABLE_GAP
+
+    # Reuse the per-category subtotals instead of walking every item again
+    section_total = math.fsum(category_subtotals)
+    writer.row(f"TOTAL {name}", fmt(section_total, _AMOUNT_FORMAT), _TOTAL_ROW)
+
+
+# Sections with at least this many rows in total are rendered in two worker
+# processes on multi-core hosts; below it the round trip and the merge cost
+# more than they save
+PARALLEL_MIN_ROWS = 2000
+
+_section_pool = None
+_section_pool_lock = threading.Lock()
+
+
+def _get_section_pool():
+    global _section_pool
+    with _section_pool_lock:
+        if _section_pool is None:
+            # Never fork: this runs on request/job threads while other threads
+            # hold the httpx and token bucket locks
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _section_pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context(method))
+        return _section_pool
+
+
+def _reset_section_pool():
+    """Drop a broken pool so the next large render starts a fresh one."""
+    global _section_pool
+    with _section_pool_lock:
+        if _section_pool is not None:
+            _section_pool.shutdown(wait=False, cancel_futures=True)
+            _section_pool = None
+
+
+def _render_section_to_bytes(name, title, items_dict, with_title=False):
+    """Render a single section as a standalone PDF and return its bytes."""
+    buffer = io.BytesIO()
+    writer = _PdfWriter(buffer)
+    if with_title:
+        writer.text(_DOCUMENT_TITLE, _TITLE_STYLE)
+    _render_section(writer, name, title, items_dict)
+    writer.save()
+    return buffer.getvalue()
+
+
+def _render_sections_in_parallel(sections):
+    """Render each section in the worker pool; returns the PDF bytes in order."""
+    pool = _get_section_pool()
+    futures = [
+        pool.submit(_render_section_to_bytes, name, title, items_dict, i == 0)
+        for i, (name, title, items_dict) in enumerate(sections)
+    ]
+    return [future.result() for future in futures]
+
+
+@contextmanager
+def _atomic_file(output_path):
+    """
+    Open a temporary file next to output_path and move it into place on success.
+
+    The file is fsynced before os.replace, so readers see either the previous
+    PDF or the complete new one, never a partially written file.
+    """
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _sections_of(data_dict):
+    # (name, title, items_dict) for each section that has at least one item
+    sections = [(name, title, data_dict.get(name) or {}) for name, title in _SECTIONS]
+    return [section for section in sections if any(section[2].values())]
+
+
+def _draw_document(f, sections):
+    """Draw the title and the given sections sequentially on one canvas."""
+    writer = _PdfWriter(f)
+
+    # Add title
+    writer.text(_DOCUMENT_TITLE, _TITLE_STYLE)
+
+    for i, (name, title, items_dict) in enumerate(sections):
+        # Each section after the first starts on a new page
+        if i:
+            writer.new_page()
+        _render_section(writer, name, title, items_dict)
+    writer.save()
 
 
 def write_to_pdf(data_dict, output_path):
     """
     Write the reclassified balance sheet to a PDF file.
 
+    Sections without any items are skipped, and PASSIVO only starts a new page
+    when ATTIVO was drawn before it. Large balance sheets render the two
+    sections in separate processes and merge the PDFs; everything else is
+    drawn sequentially on one canvas.
+
     Args:
         data_dict: Dictionary containing ATTIVO and PASSIVO sections
         output_path: Path where the PDF will be saved
     """
-    # Create PDF document
-    doc = SimpleDocTemplate(
-        output_path,
-        pagesize=A4,
-        rightMargin=2 * cm,
-        leftMargin=2 * cm,
-        topMargin=2 * cm,
-        bottomMargin=2 * cm
-    )
-
-    # Container for PDF elements
-    elements = []
-
-    # Define styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=16,
-        textColor=colors.HexColor('#1f4788'),
-        spaceAfter=20,
-        alignment=TA_CENTER
-    )
-
-    section_style = ParagraphStyle(
-        'SectionTitle',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor('#2c5f9e'),
-        spaceAfter=12,
-        spaceBefore=12
-    )
-
-    subsection_style = ParagraphStyle(
-        'SubsectionTitle',
-        parent=styles['Heading3'],
-        fontSize=11,
-        textColor=colors.HexColor('#444444'),
-        spaceAfter=8,
-        spaceBefore=8
-    )
+    sections = _sections_of(data_dict)
+
+    parts = None
+    if len(sections) > 1:
+        rows = sum(len(items) for _, _, items_dict in sections for items in items_dict.values())
+        if rows >= PARALLEL_MIN_ROWS and (os.cpu_count() or 1) > 1:
+            try:
+                parts = _render_sections_in_parallel(sections)
+            except (OSError, BrokenProcessPool):
+                # No working multiprocessing here (e.g. serverless sandbox) or a
+                # worker died; fall back to rendering in this process
+                _reset_section_pool()
+
+    with _atomic_file(output_path) as f:
+        if parts is not None:
+            merged = PdfWriter()
+            for part in parts:
+                merged.append(io.BytesIO(part))
+            merged.write(f)
+        else:
+            _draw_document(f, sections)
+    print(f"PDF successfully created: {output_path}")
 
-    # Add title
-    title = Paragraph("Reclassified Balance Sheet - Article 2424 CEE", title_style)
-    elements.append(title)
-    elements.append(Spacer(1, 0.5 * cm))
-
-    # Process ATTIVO (Assets)
-    if "ATTIVO" in data_dict:
-        section_title = Paragraph("ATTIVO (Assets)", section_style)
-        elements.append(section_title)
-
-        for category, items in data_dict["ATTIVO"].items():
-            if items:  # Only process if there are items
-                # Add category header
-                category_header = Paragraph(category, subsection_style)
-                elements.append(category_header)
-
-                # Create table data
-                table_data = [["Description", "Amount (€)"]]
-
-                for item in items:
-                    label = item.get("label", "")
-                    amount = item.get("amount", 0)
-                    table_data.append([label, f"{amount:,.2f}"])
-
-                # Calculate subtotal
-                subtotal = sum(item.get("amount", 0) for item in items)
-                table_data.append(["Subtotal", f"{subtotal:,.2f}"])
-
-                # Create and style table
-                table = Table(table_data, colWidths=[12 * cm, 4 * cm])
-                table.setStyle(TableStyle([
-                    # Header row
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2c5f9e')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 10),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-
-                    # Data rows
-                    ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-                    ('TEXTCOLOR', (0, 1), (-1, -2), colors.black),
-                    ('ALIGN', (1, 1), (1, -1), 'RIGHT'),
-                    ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),
-                    ('FONTSIZE', (0, 1), (-1, -2), 9),
-                    ('GRID', (0, 0), (-1, -2), 0.5, colors.grey),
-
-                    # Subtotal row
-                    ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#d9e8f5')),
-                    ('TEXTCOLOR', (0, -1), (-1, -1), colors.black),
-                    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, -1), (-1, -1), 10),
-                    ('LINEABOVE', (0, -1), (-1, -1), 1.5, colors.black),
-                ]))
-
-                elements.append(table)
-                elements.append(Spacer(1, 0.3 * cm))
-
-        # Calculate total ATTIVO
-        total_attivo = 0
-        for category, items in data_dict["ATTIVO"].items():
-            total_attivo += sum(item.get("amount", 0) for item in items)
-
-        total_table = Table([["TOTAL ATTIVO", f"{total_attivo:,.2f}"]], colWidths=[12 * cm, 4 * cm])
-        total_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#1f4788')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.whitesmoke),
-            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('TOPPADDING', (0, 0), (-1, -1), 12),
-        ]))
-        elements.append(total_table)
-
-    # Add page break before PASSIVO
-    elements.append(PageBreak())
-
-    # Process PASSIVO (Liabilities)
-    if "PASSIVO" in data_dict:
-        section_title = Paragraph("PASSIVO (Liabilities & Equity)", section_style)
-        elements.append(section_title)
-
-        for category, items in data_dict["PASSIVO"].items():
-            if items:  # Only process if there are items
-                # Add category header
-                category_header = Paragraph(category, subsection_style)
-                elements.append(category_header)
-
-                # Create table data
-                table_data = [["Description", "Amount (€)"]]
-
-                for item in items:
-                    label = item.get("label", "")
-                    amount = item.get("amount", 0)
-                    table_data.append([label, f"{amount:,.2f}"])
-
-                # Calculate subtotal
-                subtotal = sum(item.get("amount", 0) for item in items)
-                table_data.append(["Subtotal", f"{subtotal:,.2f}"])
-
-                # Create and style table
-                table = Table(table_data, colWidths=[12 * cm, 4 * cm])
-                table.setStyle(TableStyle([
-                    # Header row
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2c5f9e')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 10),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-
-                    # Data rows
-                    ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-                    ('TEXTCOLOR', (0, 1), (-1, -2), colors.black),
-                    ('ALIGN', (1, 1), (1, -1), 'RIGHT'),
-                    ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),
-                    ('FONTSIZE', (0, 1), (-1, -2), 9),
-                    ('GRID', (0, 0), (-1, -2), 0.5, colors.grey),
-
-                    # Subtotal row
-                    ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#d9e8f5')),
-                    ('TEXTCOLOR', (0, -1), (-1, -1), colors.black),
-                    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, -1), (-1, -1), 10),
-                    ('LINEABOVE', (0, -1), (-1, -1), 1.5, colors.black),
-                ]))
-
-                elements.append(table)
-                elements.append(Spacer(1, 0.3 * cm))
-
-        # Calculate total PASSIVO
-        total_passivo = 0
-        for category, items in data_dict["PASSIVO"].items():
-            total_passivo += sum(item.get("amount", 0) for item in items)
-
-        total_table = Table([["TOTAL PASSIVO", f"{total_passivo:,.2f}"]], colWidths=[12 * cm, 4 * cm])
-        total_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#1f4788')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.whitesmoke),
-            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('TOPPADDING', (0, 0), (-1, -1), 12),
-        ]))
-        elements.append(total_table)
-    doc.build(elements)
+
+def write_many_to_pdf(data_dicts, output_path):
+    """
+    Write several reclassified balance sheets to one PDF, each starting on a new page.
+
+    Args:
+        data_dicts: List of dictionaries containing ATTIVO and PASSIVO sections
+        output_path: Path where the PDF will be saved
+    """
+    if len(data_dicts) == 1:
+        write_to_pdf(data_dicts[0], output_path)
+        return
+
+    merged = PdfWriter()
+    for data_dict in data_dicts:
+        buffer = io.BytesIO()
+        _draw_document(buffer, _sections_of(data_dict))
+        buffer.seek(0)
+        merged.append(buffer)
+    with _atomic_file(output_path) as f:
+        merged.write(f)
     print(f"PDF successfully created: {output_path}")
 
+
 # 4. Run end-to-end
 if __name__ == "__main__":
     if __name__ == "__main__":